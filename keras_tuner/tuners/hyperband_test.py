@@ -13,8 +13,10 @@
 # limitations under the License.
 
 import logging
+from unittest.mock import patch
 
 import numpy as np
+import pytest
 import tensorflow as tf
 
 import keras_tuner
@@ -29,23 +31,57 @@ def build_model(hp):
             tf.keras.layers.Dense(hp.Int(f"units{str(i)}", 1, 5), activation="relu")
         )
 
-        model.add(
-            tf.keras.layers.Lambda(lambda x: x + hp.Float(f"bias{str(i)}", -1, 1))
-        )
+        bias = hp.Float(f"bias{str(i)}", -1, 1)
+        model.add(tf.keras.layers.Lambda(lambda x, bias=bias: x + bias))
 
     model.add(tf.keras.layers.Dense(1, activation="sigmoid"))
     model.compile("sgd", "mse")
     return model
 
 
-def test_hyperband_oracle_bracket_configs(tmp_path):
-    oracle = hyperband_module.HyperbandOracle(
-        objective=keras_tuner.Objective("score", "max"),
-        hyperband_iterations=1,
-        max_epochs=8,
-        factor=2,
-    )
-    oracle._set_project_dir(tmp_path, "untitled")
+class MockModel(tf.keras.Model):
+    """Skips training and reports a score derived from its hyperparameters."""
+
+    def __init__(self, score):
+        super(MockModel, self).__init__()
+        self.score = score
+
+    def fit(self, *args, **kwargs):
+        history = tf.keras.callbacks.History()
+        history.history = {"val_loss": [self.score]}
+        return history
+
+    def evaluate(self, *args, **kwargs):
+        return self.score
+
+    def save_weights(self, *args, **kwargs):
+        pass
+
+    def load_weights(self, *args, **kwargs):
+        pass
+
+
+def build_mock_model(hp):
+    values = []
+    for i in range(hp.Int("layers", 1, 3)):
+        values.append(hp.Int(f"units{str(i)}", 1, 5))
+        values.append(hp.Float(f"bias{str(i)}", -1, 1))
+    return MockModel(float(np.float32(hash(tuple(values)) & 0xFFFF)))
+
+
+def build_bracket_math_oracle(max_epochs, factor, hyperband_iterations=1):
+    # Only set the attributes read by the bracket math, so no project
+    # directory is needed.
+    oracle = object.__new__(hyperband_module.HyperbandOracle)
+    oracle.hyperband_iterations = hyperband_iterations
+    oracle.max_epochs = max_epochs
+    oracle.min_epochs = 1
+    oracle.factor = factor
+    return oracle
+
+
+def test_hyperband_oracle_bracket_configs():
+    oracle = build_bracket_math_oracle(max_epochs=8, factor=2)
 
     # 8, 4, 2, 1 starting epochs.
     assert oracle._get_num_brackets() == 4
@@ -61,119 +97,166 @@ def test_hyperband_oracle_bracket_configs(tmp_path):
     assert oracle._get_epochs(bracket_num=0, round_num=0) == 8
 
 
-def test_hyperband_oracle_one_sweep_single_thread(tmp_path):
-    hp = keras_tuner.HyperParameters()
-    hp.Float("a", -100, 100)
-    hp.Float("b", -100, 100)
-    oracle = hyperband_module.HyperbandOracle(
-        hyperparameters=hp,
-        objective=keras_tuner.Objective("score", "max"),
-        hyperband_iterations=1,
-        max_epochs=9,
-        factor=3,
-    )
-    oracle._set_project_dir(tmp_path, "untitled")
-
+def single_thread_sweep_ops(max_epochs, factor):
+    bracket_math = build_bracket_math_oracle(max_epochs=max_epochs, factor=factor)
+    ops = []
     score = 0
-    for bracket_num in reversed(range(oracle._get_num_brackets())):
-        for round_num in range(oracle._get_num_rounds(bracket_num)):
-            for _ in range(oracle._get_size(bracket_num, round_num)):
-                trial = oracle.create_trial("tuner0")
-                assert trial.status == "RUNNING"
+    for bracket_num in reversed(range(bracket_math._get_num_brackets())):
+        for round_num in range(bracket_math._get_num_rounds(bracket_num)):
+            round_size = bracket_math._get_size(bracket_num, round_num)
+            for _ in range(round_size):
                 score += 1
-                oracle.update_trial(trial.trial_id, {"score": score})
-                trial.status = "COMPLETED"
-                oracle.end_trial(trial)
-            assert len(oracle._brackets[0]["rounds"][round_num]) == oracle._get_size(
-                bracket_num, round_num
-            )
-        assert len(oracle._brackets) == 1
+                ops.append(("create", "tuner0", "RUNNING"))
+                ops.append(("update", "tuner0", score))
+                ops.append(("end", "tuner0"))
+            ops.append(("round_size", bracket_num, round_num))
+        ops.append(("num_brackets", 1))
 
     # Iteration should now be complete.
-    trial = oracle.create_trial("tuner0")
-    assert trial.status == "STOPPED", oracle.hyperband_iterations
-    assert len(oracle.ongoing_trials) == 0
-
+    ops.append(("create", "tuner0", "STOPPED", "hyperband_iterations"))
+    ops.append(("num_ongoing", 0))
     # Brackets should all be finished and removed.
-    assert len(oracle._brackets) == 0
-
-    best_trial = oracle.get_best_trials()[0]
-    assert best_trial.score == score
+    ops.append(("num_brackets", 0))
+    ops.append(("best_score", score))
+    return ops
 
 
-def test_hyperband_oracle_one_sweep_parallel(tmp_path):
-    hp = keras_tuner.HyperParameters()
-    hp.Float("a", -100, 100)
-    hp.Float("b", -100, 100)
-    oracle = hyperband_module.HyperbandOracle(
-        hyperparameters=hp,
-        objective=keras_tuner.Objective("score", "max"),
-        hyperband_iterations=1,
-        max_epochs=4,
-        factor=2,
-    )
-    oracle._set_project_dir(tmp_path, "untitled")
-
+def parallel_sweep_ops():
     # All round 0 trials from different brackets can be run
     # in parallel.
-    round0_trials = []
-    for i in range(10):
-        t = oracle.create_trial(f"tuner{str(i)}")
-        assert t.status == "RUNNING"
-        round0_trials.append(t)
-
-    assert len(oracle._brackets) == 3
+    ops = [("create", f"tuner{str(i)}", "RUNNING") for i in range(10)]
+    ops.append(("num_brackets", 3))
 
     # Round 1 can't be run until enough models from round 0
     # have completed.
-    t = oracle.create_trial("tuner10")
-    assert t.status == "IDLE"
-
-    for t in round0_trials:
-        oracle.update_trial(t.trial_id, {"score": 1})
-        t.status = "COMPLETED"
-        oracle.end_trial(t)
-
-    round1_trials = []
-    for i in range(4):
-        t = oracle.create_trial(f"tuner{str(i)}")
-        assert t.status == "RUNNING"
-        round1_trials.append(t)
+    ops.append(("create", "tuner10", "IDLE"))
+    for i in range(10):
+        ops.append(("update", f"tuner{str(i)}", 1))
+        ops.append(("end", f"tuner{str(i)}"))
 
+    ops.extend(("create", f"tuner{str(i)}", "RUNNING") for i in range(4))
     # Bracket 0 is complete as it only has round 0.
-    assert len(oracle._brackets) == 2
+    ops.append(("num_brackets", 2))
 
     # Round 2 can't be run until enough models from round 1
     # have completed.
-    t = oracle.create_trial("tuner10")
-    assert t.status == "IDLE"
-
-    for t in round1_trials:
-        oracle.update_trial(t.trial_id, {"score": 1})
-        t.status = "COMPLETED"
-        oracle.end_trial(t)
+    ops.append(("create", "tuner10", "IDLE"))
+    for i in range(4):
+        ops.append(("update", f"tuner{str(i)}", 1))
+        ops.append(("end", f"tuner{str(i)}"))
 
     # Only one trial runs in round 2.
-    round2_trial = oracle.create_trial("tuner0")
-
-    assert len(oracle._brackets) == 1
+    ops.append(("create", "tuner0", "RUNNING"))
+    ops.append(("num_brackets", 1))
 
     # No more trials to run, but wait for existing brackets to end.
-    t = oracle.create_trial("tuner10")
-    assert t.status == "IDLE"
+    ops.append(("create", "tuner10", "IDLE"))
+    ops.append(("update", "tuner0", 1))
+    ops.append(("end", "tuner0"))
+    ops.append(
+        ("create", "tuner10", "STOPPED", "_current_bracket", "_current_iteration")
+    )
+    return ops
+
+
+SINGLE_THREAD_KWARGS = {"max_epochs": 9, "factor": 3}
+PARALLEL_KWARGS = {"max_epochs": 4, "factor": 2}
 
-    oracle.update_trial(round2_trial.trial_id, {"score": 1})
-    round2_trial.status = "COMPLETED"
-    oracle.end_trial(round2_trial)
+# Each script is a name, the `HyperbandOracle` arguments, and the ops to run.
+SWEEP_SCRIPTS = [
+    (
+        "single_thread",
+        SINGLE_THREAD_KWARGS,
+        single_thread_sweep_ops(**SINGLE_THREAD_KWARGS),
+    ),
+    ("parallel", PARALLEL_KWARGS, parallel_sweep_ops()),
+]
 
-    t = oracle.create_trial("tuner10")
-    assert t.status == "STOPPED", oracle._current_sweep
+
+@pytest.fixture
+def oracle(request, tmp_path_factory):
+    name, kwargs = request.param
+    hp = keras_tuner.HyperParameters()
+    hp.Float("a", -100, 100)
+    hp.Float("b", -100, 100)
+    oracle = hyperband_module.HyperbandOracle(
+        hyperparameters=hp,
+        objective=keras_tuner.Objective("score", "max"),
+        hyperband_iterations=1,
+        **kwargs,
+    )
+    project_dir = tmp_path_factory.mktemp(name, numbered=False)
+    oracle._set_project_dir(project_dir, "untitled")
+    return oracle
+
+
+def run_ops(oracle, ops):
+    """Runs a script of ops against the oracle, asserting on its state.
+
+    The oracle and trial states are only written to disk once all the ops
+    are done, then reloaded into a new oracle to check they persisted.
+
+    Args:
+        oracle: A fresh `HyperbandOracle`.
+        ops: A list of tuples, each an op name followed by its arguments.
+    """
+    trials = {}
+    with patch.object(oracle, "save"), patch.object(oracle, "_save_trial"):
+        for op, *args in ops:
+            if op == "create":
+                # Any extra arguments name oracle attributes to report on failure.
+                tuner_id, status, *diagnostics = args
+                trials[tuner_id] = oracle.create_trial(tuner_id)
+                assert trials[tuner_id].status == status, {
+                    name: getattr(oracle, name) for name in diagnostics
+                }
+            elif op == "update":
+                tuner_id, score = args
+                oracle.update_trial(trials[tuner_id].trial_id, {"score": score})
+            elif op == "end":
+                trial = trials.pop(args[0])
+                trial.status = "COMPLETED"
+                oracle.end_trial(trial)
+            elif op == "round_size":
+                bracket_num, round_num = args
+                size = oracle._get_size(bracket_num, round_num)
+                assert len(oracle._brackets[0]["rounds"][round_num]) == size
+            elif op == "num_brackets":
+                assert len(oracle._brackets) == args[0]
+            elif op == "num_ongoing":
+                assert len(oracle.ongoing_trials) == args[0]
+            elif op == "best_score":
+                assert oracle.get_best_trials()[0].score == args[0]
+            else:
+                raise ValueError(f"Unknown op: {op}")
+
+    for trial in oracle.trials.values():
+        oracle._save_trial(trial)
+    oracle.save()
+
+    # The deferred writes should restore the same state.
+    reloaded = hyperband_module.HyperbandOracle(objective=oracle.objective)
+    reloaded._set_project_dir(oracle._directory, oracle._project_name)
+    assert len(reloaded.trials) == len(oracle.trials)
+    assert reloaded._brackets == oracle._brackets
+
+
+@pytest.mark.parametrize(
+    "oracle, ops",
+    [
+        pytest.param((name, kwargs), ops, id=name)
+        for name, kwargs, ops in SWEEP_SCRIPTS
+    ],
+    indirect=["oracle"],
+)
+def test_hyperband_oracle_sweep(oracle, ops):
+    run_ops(oracle, ops)
 
 
 def test_hyperband_integration(tmp_path):
     tuner = hyperband_module.Hyperband(
         objective="val_loss",
-        hypermodel=build_model,
+        hypermodel=build_mock_model,
         hyperband_iterations=2,
         max_epochs=6,
         factor=3,
@@ -188,6 +271,12 @@ def test_hyperband_integration(tmp_path):
     assert "units1" in updated_hps
     assert "bias1" in updated_hps
 
+    # Make sure later rounds continued from the best trials of earlier rounds.
+    assert any(
+        "tuner/trial_id" in trial.hyperparameters.values
+        for trial in tuner.oracle.trials.values()
+    )
+
     tf.get_logger().setLevel(logging.ERROR)
 
     best_score = tuner.oracle.get_best_trials()[0].score
@@ -198,7 +287,7 @@ def test_hyperband_integration(tmp_path):
 def test_hyperband_save_and_restore(tmp_path):
     tuner = hyperband_module.Hyperband(
         objective="val_loss",
-        hypermodel=build_model,
+        hypermodel=build_mock_model,
         hyperband_iterations=1,
         max_epochs=7,
         factor=2,
@@ -221,6 +310,10 @@ def test_hyperband_save_and_restore(tmp_path):
     assert tuner.oracle._current_iteration == 1
 
 
+def flatten_weights(weights):
+    return np.concatenate([weight.numpy().ravel() for weight in weights])
+
+
 def test_hyperband_load_weights(tmp_path):
     tuner = hyperband_module.Hyperband(
         objective="val_loss",
@@ -252,9 +345,9 @@ def test_hyperband_load_weights(tmp_path):
     hp = trial.hyperparameters
     assert "tuner/trial_id" in hp
     new_model = tuner._try_build(hp)
-    assert new_model.predict(x).shape == y.shape
+    assert tuple(new_model(x, training=False).shape) == y.shape
     # get new model weights
-    new_model_weights = new_model.weights.copy()
+    new_model_weights = new_model.weights
     # get weights from the best model in round 0
     best_trial_round_0_id = hp["tuner/trial_id"]
     best_hp_round_0 = tuner.oracle.trials[best_trial_round_0_id].hyperparameters
@@ -262,13 +355,13 @@ def test_hyperband_load_weights(tmp_path):
     best_model_round_0.load_weights(
         tuner._get_checkpoint_fname(best_trial_round_0_id)
     )
-    assert best_model_round_0.predict(x).shape == y.shape
-    best_model_round_0_weights = best_model_round_0.weights.copy()
+    assert tuple(best_model_round_0(x, training=False).shape) == y.shape
+    best_model_round_0_weights = best_model_round_0.weights
     # compare the weights
-    assert len(new_model_weights) == len(best_model_round_0_weights)
-    assert all(
-        np.alltrue(new_weight == best_old_weight)
-        for new_weight, best_old_weight in zip(
-            new_model_weights, best_model_round_0_weights
-        )
+    assert [weight.shape for weight in new_model_weights] == [
+        weight.shape for weight in best_model_round_0_weights
+    ]
+    assert np.array_equal(
+        flatten_weights(new_model_weights),
+        flatten_weights(best_model_round_0_weights),
     )